@@ -161,8 +161,8 @@ def create_single_dataset(base_dir='/home/fagg/datasets/radiant_earth/pa', full_
     :param repeat: repeat data set indefinitely (default = False)
     :param shuffle: shuffle buffer size (default = None -> dont shuffle) 
     :param batch_size: Size of the batches to be produced by this data set
-    :param prefetch: Number of batches to prefetch in parallel with training
-    :param num_parallel_calls: Number of threads to use for the data loading process
+    :param prefetch: Number of batches to prefetch in parallel with training (-1 = use AutoTune)
+    :param num_parallel_calls: Number of threads to use for the data loading process (-1 = use AutoTune)
     
     :return: TF Dataset that emits tuples (ins, outs)
                 ins is a TF Tensor of shape batch_size x 256 x 256 x 24
@@ -170,7 +170,9 @@ def create_single_dataset(base_dir='/home/fagg/datasets/radiant_earth/pa', full_
     '''
     if num_parallel_calls == -1:
         num_parallel_calls = tf.data.AUTOTUNE
-    
+
+    if prefetch == -1:
+        prefetch = tf.data.AUTOTUNE
     
     # Full list of files in the dataset
     data = tf.data.Dataset.list_files('%s/%s/F%d/%s.npz'%(base_dir, partition, fold, filt), shuffle=False)
@@ -283,7 +285,8 @@ def create_datasets(base_dir='/home/fagg/datasets/radiant_earth/pa', full_sat=Tr
 
 
 @tf.autograph.experimental.do_not_convert
-def create_diffusion_example(I:tf.float32, L:tf.float32, patch_size:int, alpha:tf.Tensor, t:tf.Tensor)->[tf.Tensor]:
+def create_diffusion_example(I:tf.float32, L:tf.float32, patch_size:int, sqrt_alpha:tf.Tensor,
+                             sqrt_one_minus_alpha:tf.Tensor, t:tf.Tensor)->[tf.Tensor]:
     #nalpha:tf.Tensor, generator:tf.random.Generator)
     '''
     Given an input image and a label image, produce a single example for training a diffusion network
@@ -291,7 +294,8 @@ def create_diffusion_example(I:tf.float32, L:tf.float32, patch_size:int, alpha:t
     :param I: Input image
     :param L: Label image
     :param patch_size: size of each image on each side
-    :param alpha: TF tensor of alpha blending values
+    :param sqrt_alpha: TF tensor of sqrt(alpha) blending values (nsteps x 1 x 1 x 1)
+    :param sqrt_one_minus_alpha: TF tensor of sqrt(1-alpha) blending values (nsteps x 1 x 1 x 1)
     :param t: Time step to generate the solution for
 
     :return: Label image, Time image, blended image, and the raw noise.  All are patch_size x patch_size x ?
@@ -305,19 +309,45 @@ def create_diffusion_example(I:tf.float32, L:tf.float32, patch_size:int, alpha:t
     # t = tf.random.uniform(shape=(1,), minval=0, maxval=nalpha, dtype=tf.dtypes.int32)
     # assert alpha.shape == (50,) and t.shape == (1,), "SHAPES DON'T MATCH %s %s"%(str(alpha.shape), str(t.shape))
 
-    # Pull out the alpha that corresponds to the chosen time
-    a = tf.gather_nd(alpha, t)
+    # Pull out the blending factors that correspond to the chosen time
+    sa = tf.gather(sqrt_alpha, t[0])
+    s1a = tf.gather(sqrt_one_minus_alpha, t[0])
     
     # Scale pixels to +/- 1
     I = tf.multiply(I, 2.0) - 1.0
     
     # Output image is a blend of the original image and the noise
-    image = tf.multiply(I, tf.math.sqrt(a)) + tf.multiply(noise, tf.math.sqrt(1-a))
+    image = tf.multiply(I, sa) + tf.multiply(noise, s1a)
 
     # Strange to now be returning t again here - but necessary for the mapping process
     return tf.cast(L, tf.dtypes.float32), tf.cast(t, tf.dtypes.int32), \
         tf.cast(image, tf.dtypes.float32), tf.cast(noise, tf.dtypes.float32)
 
+
+def _noise_and_batch(ds, add_noise, batch_size, num_parallel_calls, map_and_batch):
+    '''
+    Apply the noising map to a dataset of I/L pairs and batch the results
+
+    :param ds: TF Dataset of I/L pairs
+    :param add_noise: Function mapping an I/L pair to a diffusion example
+    :param batch_size: Size of the batches (None -> no batching)
+    :param num_parallel_calls: Number of threads to use for the map
+    :param map_and_batch: True -> use the fused map_and_batch op
+
+    :return: TF Dataset of (batched) 4-tuples
+    '''
+    if map_and_batch and batch_size is not None:
+        return ds.apply(tf.data.experimental.map_and_batch(add_noise, batch_size=batch_size,
+                                                           num_parallel_calls=num_parallel_calls))
+
+    ds = ds.map(add_noise, num_parallel_calls=num_parallel_calls)
+
+    # Batch the individual elements
+    if batch_size is not None:
+        ds = ds.batch(batch_size)
+
+    return ds
+
     
 @tf.autograph.experimental.do_not_convert
 def create_diffusion_dataset(alpha,
@@ -332,7 +362,11 @@ def create_diffusion_dataset(alpha,
                              shuffle_validation=None,
                              batch_size=8,
                              prefetch=2,
-                             num_parallel_calls=4):
+                             num_parallel_calls=4,
+                             sqrt_alpha=None,
+                             sqrt_one_minus_alpha=None,
+                             use_py_func=True,
+                             map_and_batch=False):
 
     '''
     Create TF Datasets for training a diffusion model
@@ -347,14 +381,19 @@ def create_diffusion_dataset(alpha,
                     '*[012]' means use all files ending zero, one or two
                     You should not need to change from default unless you want to use a smaller training set
     :param cache_dir: None -> no cache; empty string -> cache to RAM; 
-                      directory path -> cache to 3 files (on the supercomputer, this is LSCRATCH)
+                      directory path -> cache to 2 files (on the supercomputer, this is LSCRATCH)
     :param repeat: repeat data set indefinitely (default = False)
     :param shuffle: shuffle buffer size (default = None -> dont shuffle)
     :param repeat_validation: repeat data set indefinitely (default = False) 
     :param shuffle_shuffle: shuffle buffer size (default = None -> dont shuffle) 
     :param batch_size: Size of the batches to be produced by this data set 
-    :param prefetch: Number of batches to prefetch in parallel with training 
+    :param prefetch: Number of batches to prefetch in parallel with training (-1 = use AutoTune)
     :param num_parallel_calls: Number of threads to use for the data loading process (-1 = use AutoTune)
+    :param sqrt_alpha: precomputed sqrt(alpha), shaped nsteps x 1 x 1 x 1 (None -> compute from alpha)
+    :param sqrt_one_minus_alpha: precomputed sqrt(1-alpha), shaped nsteps x 1 x 1 x 1 (None -> compute from alpha)
+    :param use_py_func: True -> noise each example through tf.py_function; False -> noise
+                      in the graph (no Python round trip)
+    :param map_and_batch: True -> fuse the noising map and the batching into a single op
     
     :return: ds_training, ds_validation: TF Datasets for training formatted for using with model.fit()
         2-Tuple of:
@@ -367,7 +406,12 @@ def create_diffusion_dataset(alpha,
           outs: noise image
  
     '''
-    
+    if num_parallel_calls == -1:
+        num_parallel_calls = tf.data.AUTOTUNE
+
+    if prefetch == -1:
+        prefetch = tf.data.AUTOTUNE
+
     # Base dataset: tuples of individual I/L pairs
     ds = create_single_dataset(base_dir=base_dir,
                                      full_sat=False,
@@ -375,36 +419,53 @@ def create_diffusion_dataset(alpha,
                                      partition='train',
                                      fold=fold,
                                      filt=filt,
-                                     cache_path=cache_dir,
+                                     cache_path=None if cache_dir is None else '' if cache_dir=='' else '%s/train_f_%d_'%(cache_dir, fold),
                                      repeat=repeat,
                                      shuffle=shuffle,
                                      batch_size=None,
                                      prefetch=None,
                                      num_parallel_calls=num_parallel_calls)
 
-    # Convert alpha and nalpha to TF constants
+    # Blending tables, shaped to broadcast against an image
+    if sqrt_alpha is None:
+        sqrt_alpha = np.sqrt(alpha).reshape(-1, 1, 1, 1)
+    if sqrt_one_minus_alpha is None:
+        sqrt_one_minus_alpha = np.sqrt(1.0 - alpha).reshape(-1, 1, 1, 1)
+
+    # Convert blending tables and nalpha to TF constants
     nalpha = tf.constant(alpha.shape[0], dtype=tf.dtypes.int32)
-    alpha_tf = tf.constant(alpha, dtype=tf.dtypes.float32)
+    sqrt_alpha_tf = tf.constant(sqrt_alpha, dtype=tf.dtypes.float32)
+    sqrt_one_minus_alpha_tf = tf.constant(sqrt_one_minus_alpha, dtype=tf.dtypes.float32)
 
     # Random number generator for time indices
     generator = tf.random.Generator.from_seed(42)
+
+    def add_noise(I, L):
+        '''
+        Map an I/L pair to a diffusion example.  The time step is sampled here and handed
+        to create_diffusion_example()
+        '''
+        t = generator.uniform(shape=(1,), minval=0, maxval=nalpha, dtype=tf.dtypes.int32)
+
+        if use_py_func:
+            L, T, image, noise = tf.py_function(func=create_diffusion_example,
+                                                inp=[I, L, patch_size, sqrt_alpha_tf, sqrt_one_minus_alpha_tf, t],
+                                                Tout=(tf.float32, tf.int32, tf.float32, tf.float32))
+
+            # py_function loses the static shapes; restore them so that the model (and XLA)
+            #  see fixed-size inputs
+            return tf.ensure_shape(L, (patch_size, patch_size, None)), tf.ensure_shape(T, (1,)), \
+                tf.ensure_shape(image, (patch_size, patch_size, 3)), tf.ensure_shape(noise, (patch_size, patch_size, 3))
+
+        # Graph-native: gathers directly from the constant tables, no Python round trip
+        return create_diffusion_example(I, L, patch_size, sqrt_alpha_tf, sqrt_one_minus_alpha_tf, t)
     
     # Create DS for Diffusion: this is a 4-tuple
-    ds = ds.map(lambda I, L: tf.py_function(func=create_diffusion_example, inp=[I, L, patch_size, alpha_tf,
-                                                                                generator.uniform(shape=(1,),
-                                                                                                  minval=0,
-                                                                                                  maxval=nalpha,
-                                                                                                  dtype=tf.dtypes.int32)
-                                                                            ], 
-                                            Tout=(tf.float32, tf.int32, tf.float32, tf.float32)), 
-                num_parallel_calls=num_parallel_calls)
-        
-    # Batch the individual elements
-    if batch_size is not None:
-        ds = ds.batch(batch_size)
+    ds = _noise_and_batch(ds, add_noise, batch_size, num_parallel_calls, map_and_batch)
 
     # Format for input into a Keras Model
-    ds = ds.map(lambda L, T, image, noise: ({'label_input': L, 'time_input': T, 'image_input': image}, noise))
+    ds = ds.map(lambda L, T, image, noise: ({'label_input': L, 'time_input': T, 'image_input': image}, noise),
+                num_parallel_calls=num_parallel_calls)
     
     # Buffer multiple batches
     if prefetch is not None:
@@ -420,7 +481,7 @@ def create_diffusion_dataset(alpha,
                                      partition='train',
                                      fold=fold,
                                      filt='*9',
-                                     cache_path=cache_dir,
+                                     cache_path=None if cache_dir is None else '' if cache_dir=='' else '%s/validation_f_%d_'%(cache_dir, fold),
                                      repeat=repeat_validation,
                                      shuffle=shuffle_validation,
                                      batch_size=None,
@@ -428,20 +489,11 @@ def create_diffusion_dataset(alpha,
                                      num_parallel_calls=num_parallel_calls)
     
     # Create ds_valid for Diffusion: this is a 4-tuple
-    ds_valid = ds_valid.map(lambda I, L: tf.py_function(func=create_diffusion_example, inp=[I, L, patch_size, alpha_tf,
-                                                                                            generator.uniform(shape=(1,),
-                                                                                                              minval=0,
-                                                                                                              maxval=nalpha,
-                                                                                                              dtype=tf.dtypes.int32)],
-                                                        Tout=(tf.float32, tf.int32, tf.float32, tf.float32)), 
-                            num_parallel_calls=num_parallel_calls)
-        
-    # Batch the individual elements
-    if batch_size is not None:
-        ds_valid = ds_valid.batch(batch_size)
+    ds_valid = _noise_and_batch(ds_valid, add_noise, batch_size, num_parallel_calls, map_and_batch)
 
     # Format for input into a Keras Model
-    ds_valid = ds_valid.map(lambda L, T, image, noise: ({'label_input': L, 'time_input': T, 'image_input': image}, noise))
+    ds_valid = ds_valid.map(lambda L, T, image, noise: ({'label_input': L, 'time_input': T, 'image_input': image}, noise),
+                            num_parallel_calls=num_parallel_calls)
     
     # Buffer multiple batches
     if prefetch is not None:
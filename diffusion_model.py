@@ -1,5 +1,6 @@
 import tensorflow as tf
-from keras.layers import Input, Dense, GlobalMaxPooling2D, UpSampling2D, Concatenate, Conv2D, AveragePooling2D
+from keras.layers import Input, Dense, GlobalMaxPooling2D, UpSampling2D, Concatenate, Conv2D, AveragePooling2D, \
+    Activation
 from tensorflow.keras.models import Model
 from network_support import *
 from diffusion_tools import *
@@ -16,7 +17,8 @@ def create_diffusion_model(image_size,
                            kernel_size=3,
                            padding='valid',
                            sdropout=None,
-                           batch_normalization=False):
+                           batch_normalization=False,
+                           embedding_dtype=None):
     '''
     Create a generator model
     :param image_size: Size of input image
@@ -31,6 +33,7 @@ def create_diffusion_model(image_size,
     :param padding: Padding for all convolutions
     :param sdropout: Probability of spatial dropout for all convolutions
     :param batch_normalization: Use batch normalization
+    :param embedding_dtype: Storage type of the positional encoding table (None -> variable dtype)
     :return: Generator model
     '''
     # Input for labels
@@ -44,7 +47,7 @@ def create_diffusion_model(image_size,
     inputs = [label_input, image_input, time_input]
 
     # Use positional encoding for time step
-    time_input = PositionEncoder(max_steps=n_steps, max_dims=n_embedding)(time_input)
+    time_input = PositionEncoder(max_steps=n_steps, max_dims=n_embedding, store_dtype=embedding_dtype)(time_input)
 
     # Broadcast scalar time step to match image size
     time_input = tf.expand_dims(time_input, axis=1)
@@ -124,7 +127,9 @@ def create_diffusion_model(image_size,
                     kernel_initializer='random_normal',
                     bias_initializer='zeros',
                     activation='linear')(tensor)
-    output = tensor
+
+    # Keep the output (and so the loss) in float32, even under mixed precision
+    output = Activation('linear', dtype='float32')(tensor)
 
     # Create model from data flow
     model = Model(inputs=inputs, outputs=output, name='diffusion')
@@ -1,21 +1,31 @@
+import functools
 import numpy as np
 import tensorflow as tf
 from tensorflow import keras
 
-def compute_beta_alpha(nsteps, beta_start, beta_end, gamma_start=0, gamma_end=0.1):
+@functools.lru_cache(maxsize=32)
+def compute_beta_alpha(nsteps, beta_start, beta_end, gamma_start=0, gamma_end=0.1, sqrt_tables=False):
     '''
     Create the beta, alpha and gamma sequences.
     Element 0 is closest to the true image; element NSTEPS-1 is closest to the
        completely noised image
+
+    Results are cached (and read-only), since sweeps tend to reuse the same schedule
+
+    :param sqrt_tables: True -> also return sqrt(alpha) and sqrt(1-alpha), each
+                    shaped NSTEPS x 1 x 1 x 1 so they broadcast directly against an image
        
     '''
-    beta = np.arange(beta_start, beta_end, (beta_end-beta_start)/nsteps)
-    sigma = np.arange(gamma_start, gamma_end, (gamma_end-gamma_start)/nsteps)
-    alpha = np.cumprod(1-beta)
+    beta = np.linspace(beta_start, beta_end, nsteps, endpoint=False, dtype=np.float32)
+    sigma = np.linspace(gamma_start, gamma_end, nsteps, endpoint=False, dtype=np.float32)
+    alpha = np.cumprod(1.0 - beta, dtype=np.float32)
 
-    return beta, alpha, sigma
+    if sqrt_tables:
+        return _read_only(beta, alpha, sigma, *_sqrt_tables(alpha))
+    return _read_only(beta, alpha, sigma)
 
-def compute_beta_alpha2(nsteps, beta_start, beta_end, gamma_start=0, gamma_end=0.1):
+@functools.lru_cache(maxsize=32)
+def compute_beta_alpha2(nsteps, beta_start, beta_end, gamma_start=0, gamma_end=0.1, sqrt_tables=False):
     '''
     Create the beta, alpha and gamma sequences.
 
@@ -23,24 +33,55 @@ def compute_beta_alpha2(nsteps, beta_start, beta_end, gamma_start=0, gamma_end=0
     
     Element 0 is closest to the true image; element NSTEPS-1 is closest to the
        completely noised image
+
+    Results are cached (and read-only), since sweeps tend to reuse the same schedule
+
+    :param sqrt_tables: True -> also return sqrt(alpha) and sqrt(1-alpha), each
+                    shaped NSTEPS x 1 x 1 x 1 so they broadcast directly against an image
        
     '''
-    t = (np.pi / 2) * (np.arange(0, 1, 1.0/nsteps)) 
-    beta = np.sin(t) * (beta_end-beta_start)+beta_start
-    sigma = np.arange(gamma_start, gamma_end, (gamma_end-gamma_start)/nsteps)
-    alpha = np.cumprod(1-beta)
+    t = np.linspace(0, np.pi / 2, nsteps, endpoint=False, dtype=np.float32)
+    beta = np.sin(t) * np.float32(beta_end - beta_start) + np.float32(beta_start)
+    sigma = np.linspace(gamma_start, gamma_end, nsteps, endpoint=False, dtype=np.float32)
+    alpha = np.cumprod(1.0 - beta, dtype=np.float32)
+
+    if sqrt_tables:
+        return _read_only(beta, alpha, sigma, *_sqrt_tables(alpha))
+    return _read_only(beta, alpha, sigma)
+
+def _sqrt_tables(alpha):
+    '''
+    Per-step sqrt(alpha) and sqrt(1-alpha), shaped for broadcasting against an image
+    '''
+    sqrt_alpha = np.sqrt(alpha).reshape(-1, 1, 1, 1).astype(np.float32)
+    sqrt_one_minus_alpha = np.sqrt(1.0 - alpha).reshape(-1, 1, 1, 1).astype(np.float32)
+    return sqrt_alpha, sqrt_one_minus_alpha
 
-    return beta, alpha, sigma
+def _read_only(*arrays):
+    '''
+    Mark arrays as read-only so that cached schedules cannot be modified by a caller
+    '''
+    for a in arrays:
+        a.setflags(write=False)
+    return arrays
 
 def convert_image(I):
     '''
     Convert an image from a form where the pixel values are nominally in a +/-1 range
     into a range of 0...1
     '''
-    I = I/2.0 + 0.5
-    I = np.maximum(I, 0.0)
-    I = np.minimum(I, 1.0)
-    return I
+    # Single output buffer; scale, shift and clip all happen in place
+    out = np.multiply(I, 0.5)
+    out += 0.5
+    np.clip(out, 0.0, 1.0, out=out)
+    return out
+
+def convert_image_tf(I):
+    '''
+    TF version of convert_image() for use with tensors (the ops can be fused
+    into a single kernel)
+    '''
+    return tf.clip_by_value(I * 0.5 + 0.5, 0.0, 1.0)
 
 
 '''
@@ -55,14 +96,17 @@ Source: Hands-On Machine Learning, p 558
 '''
 class PositionEncoder(keras.layers.Layer):
     def __init__(self, max_steps:int, max_dims:int, 
-                 dtype=tf.float32, **kwargs):
+                 dtype=None, store_dtype=None, **kwargs):
         '''
         Constructor
 
         :param max_steps: the number of tokens in the sequence
         :param max_dims: the length of the vector used to encode position
                     (must match the token encoding length if "add")
-        :param embedding_dtype: The type used for encoding of position
+        :param dtype: The type used for encoding of position (None -> use the
+                    global Keras policy)
+        :param store_dtype: The type used to store the table (None -> same as the layer
+                    variables; tf.bfloat16 or tf.float16 halves the bytes moved per lookup)
         '''
         # Call superclass constructor
         super().__init__(dtype=dtype, **kwargs)
@@ -70,17 +114,42 @@ class PositionEncoder(keras.layers.Layer):
         # Deal with odd lengths
         if max_dims % 2 == 1: max_dims += 1
 
-        # Create the positional representation
-        p, i = np.meshgrid(np.arange(max_steps), np.arange(max_dims // 2))
-        pos_emb = np.empty((max_steps, max_dims))
-        pos_emb[:, ::2] = np.sin(p / 10000**(2 * i / max_dims)).T
-        pos_emb[:, 1::2] = np.cos(p / 10000**(2 * i / max_dims)).T
-
-        # Save the state
-        self.positional_embedding = tf.constant(pos_emb.astype(self.dtype))
-
         self.max_steps = max_steps
         self.max_dims = max_dims
+        self.store_dtype = None if store_dtype is None else tf.as_dtype(store_dtype)
+
+    def build(self, input_shape):
+        '''
+        Create the positional representation (once, when the layer is first used)
+
+        :param input_shape: Shape of the index tensor (unused)
+        '''
+        # Save the state: a single non-trainable resource variable, so that it is
+        #  mirrored properly across replicas and shared between retraces
+        self.positional_embedding = self.add_weight(name='pos_emb',
+                                                    shape=(self.max_steps, self.max_dims),
+                                                    dtype=self.store_dtype or self.dtype,
+                                                    trainable=False,
+                                                    initializer=self._sinusoid_table)
+        super().build(input_shape)
+
+    def _sinusoid_table(self, shape, dtype=None):
+        '''
+        Initializer for the positional representation: outer product of the steps
+        and the inverse frequencies, with sin/cos interleaved along the last axis
+
+        :param shape: (max_steps, max_dims)
+        :param dtype: Type of the table
+        :return: TF Tensor
+        '''
+        max_steps, max_dims = shape
+        i = tf.range(max_dims // 2, dtype=tf.float32)
+        inv_freq = tf.exp(-tf.math.log(10000.0) * (2 * i / max_dims))
+        p = tf.range(max_steps, dtype=tf.float32)[:, None]
+        ang = p * inv_freq[None, :]
+        pos_emb = tf.reshape(tf.stack([tf.sin(ang), tf.cos(ang)], axis=-1), (max_steps, max_dims))
+
+        return tf.cast(pos_emb, dtype or self.dtype)
         
     def call(self, indices):
         '''
@@ -88,12 +157,20 @@ class PositionEncoder(keras.layers.Layer):
 
         Determines how the input tensor is translated into the output tensor.
 
-        :param inputs: TF Tensor that indicates which rows
+        :param indices: TF Tensor (batch x 1) that indicates which rows
         :return: TF Tensor
         '''
-        return tf.gather_nd(self.positional_embedding, indices)
+        # One time step per example (batch x 1): a plain gather along the rows is much
+        #  cheaper than gather_nd, and does not depend on the static shape being known
+        pe = tf.gather(self.positional_embedding, indices[..., 0], axis=0)
+
+        # Table is stored in the variable (or storage) dtype; hand back the compute dtype
+        #  (these differ under a mixed precision policy)
+        return tf.cast(pe, self.compute_dtype)
 
     def embedding(self):
+        if not self.built:
+            self.build(None)
         return self.positional_embedding
 
     def get_config(self):
@@ -101,6 +178,7 @@ class PositionEncoder(keras.layers.Layer):
         config.update({
             "max_steps": self.max_steps,
             "max_dims": self.max_dims,
+            "store_dtype": None if self.store_dtype is None else self.store_dtype.name,
         })
         return config
 
@@ -32,19 +32,14 @@ at the beginning of a run.
 for each training epoch
 
 '''
-import wandb
+import os
 import socket
-import tensorflow as tf
-
-from tensorflow.keras.utils import plot_model
-from tensorflow import keras
 
 # Provided
-from chesapeake_loader4 import *
 from hw8_parser import *
 
-# You need to provide this yourself
-from diffusion_model import *
+# TensorFlow, the data loader and the model are imported where they are used, so that
+#  the GPU / threading configuration can be set up before TensorFlow initializes
 
 
 def generate_fname(args):
@@ -66,6 +61,16 @@ def execute_exp(args=None, multi_gpus=False):
     :param args: Argparse arguments
     :param multi_gpus: True if there are more than one GPU
     '''
+    import tensorflow as tf
+    from tensorflow import keras
+    from tensorflow.keras.utils import plot_model
+
+    # Provided
+    from chesapeake_loader4 import create_diffusion_dataset
+    from diffusion_tools import compute_beta_alpha2
+
+    # You need to provide this yourself
+    from diffusion_model import create_diffusion_model
 
     # Check the arguments
     if args is None:
@@ -80,11 +85,20 @@ def execute_exp(args=None, multi_gpus=False):
 
     print('Batch size', args.batch)
 
+    # Mixed precision: must be set before the model is constructed
+    policies = {'none': 'float32', 'fp16': 'mixed_float16', 'bf16': 'mixed_bfloat16'}
+    tf.keras.mixed_precision.set_global_policy(policies[args.mixed_precision])
+
+    # XLA: fuse convolution / normalization / activation ops (always set, so repeated
+    #  calls from a notebook don't inherit a previous setting)
+    tf.config.optimizer.set_jit('autoclustering' if args.xla else False)
+
     if args.verbose >= 3:
         print('Starting data flow')
 
     # Compute noise schedule
-    beta, alpha, _ = compute_beta_alpha2(args.n_steps, args.beta_start, args.beta_end)
+    beta, alpha, _, sqrt_alpha, sqrt_one_minus_alpha = compute_beta_alpha2(args.n_steps, args.beta_start,
+                                                                           args.beta_end, sqrt_tables=True)
 
     # Load dataset
     if not args.no_data:
@@ -97,7 +111,30 @@ def execute_exp(args=None, multi_gpus=False):
                                                       batch_size=args.batch,
                                                       prefetch=args.prefetch,
                                                       num_parallel_calls=args.num_parallel_calls,
-                                                      alpha=alpha)
+                                                      alpha=alpha,
+                                                      sqrt_alpha=sqrt_alpha,
+                                                      sqrt_one_minus_alpha=sqrt_one_minus_alpha,
+                                                      use_py_func=not args.no_use_py_func,
+                                                      map_and_batch=args.map_and_batch)
+
+        # Pipeline options: element order does not matter for training
+        opts = tf.data.Options()
+        opts.deterministic = False
+        opts.experimental_optimization.map_parallelization = True
+        opts.experimental_optimization.parallel_batch = True
+        opts.experimental_optimization.map_fusion = True
+        opts.experimental_optimization.map_and_batch_fusion = True
+        if args.num_parallel_calls > 0:
+            # Explicit thread count; otherwise leave it to AutoTune
+            opts.threading.private_threadpool_size = args.num_parallel_calls * 2
+        ds_train = ds_train.with_options(opts)
+        ds_valid = ds_valid.with_options(opts)
+
+        # Copy the next training batch onto the GPU while the current step is running
+        #  (MirroredStrategy handles distribution across multiple GPUs itself)
+        if args.prefetch_to_device and multi_gpus == 1:
+            ds_train = ds_train.apply(tf.data.experimental.prefetch_to_device(
+                '/GPU:0', buffer_size=None if args.prefetch == -1 else args.prefetch))
     else:
         ds_train, ds_valid = None, None
 
@@ -105,27 +142,15 @@ def execute_exp(args=None, multi_gpus=False):
     if args.verbose >= 3:
         print('Building network')
 
-    # Create the network
-    if multi_gpus > 1:
-        # Multiple GPUs
-        mirrored_strategy = tf.distribute.MirroredStrategy()
-
-        with mirrored_strategy.scope():
-            # Build network: you must provide your own implementation
-            model = create_diffusion_model(image_size=(args.image_size, args.image_size),
-                                           n_channels=args.n_channels,
-                                           n_classes=args.n_classes,
-                                           n_steps=args.n_steps,
-                                           n_embedding=args.n_embedding,
-                                           filters=args.filters,
-                                           n_conv_per_step=args.n_conv_per_step,
-                                           conv_activation=args.conv_activation,
-                                           kernel_size=args.kernel_size,
-                                           padding=args.padding,
-                                           sdropout=args.sdropout,
-                                           batch_normalization=args.batch_normalization)
-    else:
-        # Single GPU
+    # Create the network: mirrored across multiple GPUs; otherwise the default
+    #  (no-op) strategy
+    strategy = tf.distribute.MirroredStrategy() if multi_gpus > 1 else tf.distribute.get_strategy()
+
+    # Under mixed precision, store the positional encoding table in the compute dtype
+    #  (halves the bytes moved per lookup)
+    embedding_dtype = None if args.mixed_precision == 'none' else tf.keras.mixed_precision.global_policy().compute_dtype
+
+    with strategy.scope():
         # Build network: you must provide your own implementation
         model = create_diffusion_model(image_size=(args.image_size, args.image_size),
                                        n_channels=args.n_channels,
@@ -138,11 +163,16 @@ def execute_exp(args=None, multi_gpus=False):
                                        kernel_size=args.kernel_size,
                                        padding=args.padding,
                                        sdropout=args.sdropout,
-                                       batch_normalization=args.batch_normalization)
+                                       batch_normalization=args.batch_normalization,
+                                       embedding_dtype=embedding_dtype)
 
     # Compile the model
     opt = tf.keras.optimizers.Adam(learning_rate=args.lrate, amsgrad=False)
-    model.compile(loss=tf.keras.losses.MeanSquaredError(), optimizer=opt, metrics=None)
+    if args.mixed_precision == 'fp16':
+        # Scale the loss to avoid underflow in the float16 gradients
+        opt = tf.keras.mixed_precision.LossScaleOptimizer(opt)
+    model.compile(loss=tf.keras.losses.MeanSquaredError(), optimizer=opt, metrics=None, jit_compile=args.xla,
+                  steps_per_execution=args.steps_per_execution)
 
     # Report model structure if verbosity is turned on
     if args.verbose >= 1 and model is not None:
@@ -174,7 +204,8 @@ def execute_exp(args=None, multi_gpus=False):
         return
 
     #####
-    # Start wandb
+    # Start wandb (only imported when we are actually running an experiment)
+    import wandb
     run = wandb.init(project=args.project, name=f'{args.exp_type}', notes=fbase, config=vars(args))
 
     # Log hostname
@@ -191,7 +222,7 @@ def execute_exp(args=None, multi_gpus=False):
     cbs.append(early_stopping_cb)
 
     # Weights and Biases
-    wandb_metrics_cb = wandb.keras.WandbMetricsLogger()
+    wandb_metrics_cb = wandb.keras.WandbMetricsLogger(log_freq=args.wandb_log_freq)
     cbs.append(wandb_metrics_cb)
 
     if args.verbose >= 3:
@@ -201,7 +232,6 @@ def execute_exp(args=None, multi_gpus=False):
     history = model.fit(ds_train,
                         epochs=args.epochs,
                         steps_per_epoch=args.steps_per_epoch,
-                        use_multiprocessing=True,
                         verbose=args.verbose >= 2,
                         validation_data=ds_valid,
                         callbacks=cbs)
@@ -223,8 +253,20 @@ if __name__ == "__main__":
     if args.verbose >= 3:
         print('Arguments parsed')
 
-    # Turn off GPU?
-    if not args.gpu or "CUDA_VISIBLE_DEVICES" not in os.environ.keys():
+    # Turn off GPU?  Hide the devices before TensorFlow enumerates them
+    no_gpu = not args.gpu or "CUDA_VISIBLE_DEVICES" not in os.environ.keys()
+    if no_gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    # Thread pools for OpenMP / TF are sized when TensorFlow is loaded.  The dataflow caps
+    #  only make sense when the network runs on a GPU (CPU-only jobs need the op threads)
+    if args.cpus_per_task is not None and args.tf_threads_mode == 'dataflow' and not no_gpu:
+        os.environ['OMP_NUM_THREADS'] = '1'
+        os.environ['TF_NUM_INTEROP_THREADS'] = str(min(4, args.cpus_per_task))
+
+    import tensorflow as tf
+
+    if no_gpu:
         tf.config.set_visible_devices([], 'GPU')
         print('NO VISIBLE DEVICES!!!!')
 
@@ -241,7 +283,13 @@ if __name__ == "__main__":
 
     # Set number of threads, if it is specified
     if args.cpus_per_task is not None:
-        tf.config.threading.set_intra_op_parallelism_threads(args.cpus_per_task)
-        tf.config.threading.set_inter_op_parallelism_threads(args.cpus_per_task)
+        if args.tf_threads_mode == 'legacy' or n_visible_devices == 0:
+            tf.config.threading.set_intra_op_parallelism_threads(args.cpus_per_task)
+            tf.config.threading.set_inter_op_parallelism_threads(args.cpus_per_task)
+        else:
+            # Keep op-level parallelism small so that most of the cores are
+            #  available to the (autotuned) tf.data workers
+            tf.config.threading.set_intra_op_parallelism_threads(min(2, args.cpus_per_task))
+            tf.config.threading.set_inter_op_parallelism_threads(min(4, args.cpus_per_task))
 
     execute_exp(args, multi_gpus=n_visible_devices)
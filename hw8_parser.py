@@ -9,6 +9,21 @@ Author: Andrew H. Fagg (andrewhfagg@gmail.com)
 import argparse
 
 
+def log_freq(value):
+    '''
+    Parse a WandB logging frequency: 'epoch', 'batch' or a positive number of batches
+    '''
+    if value in ('epoch', 'batch'):
+        return value
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n <= 0:
+        raise argparse.ArgumentTypeError("must be 'epoch', 'batch' or a positive integer (got %r)" % value)
+    return n
+
+
 def create_parser():
     '''
     Create argument parser
@@ -18,6 +33,8 @@ def create_parser():
 
     # High-level info for WandB
     parser.add_argument('--project', type=str, default='hw8', help='WandB project name')
+    parser.add_argument('--wandb_log_freq', type=log_freq, default='epoch',
+                        help="WandB metric logging frequency: 'epoch', 'batch' or a number of batches")
 
     # High-level commands
     parser.add_argument('--check', action='store_true', help='Check results for completeness')
@@ -29,7 +46,10 @@ def create_parser():
     parser.add_argument('--verbose', '-v', action='count', default=0, help="Verbosity level")
 
     # CPU/GPU
+    parser.add_argument('--xla', action='store_true', help='Compile the training step with XLA')
     parser.add_argument('--cpus_per_task', type=int, default=None, help="Number of threads to consume")
+    parser.add_argument('--tf_threads_mode', type=str, default='dataflow', choices=['legacy', 'dataflow'],
+                        help="legacy: all of cpus_per_task for intra/inter op; dataflow: with a GPU, few op threads, leave the rest to tf.data")
     parser.add_argument('--gpu', action='store_true', help='Use a GPU')
     parser.add_argument('--no-gpu', action='store_false', dest='gpu', help='Do not use the GPU')
 
@@ -47,6 +67,8 @@ def create_parser():
     parser.add_argument('--epochs', type=int, default=100, help='Training epochs')
     parser.add_argument('--lrate', type=float, default=0.001, help="Learning rate")
     parser.add_argument('--n_embedding', type=int, default=30, help='Size of embeddings')
+    parser.add_argument('--mixed_precision', type=str, default='none', choices=['none', 'fp16', 'bf16'],
+                        help='Mixed precision policy for training')
     parser.add_argument('--grad_clip', type=float, default=None, help='Threshold for gradient clipping')
 
     # Noise schedule
@@ -76,17 +98,25 @@ def create_parser():
 
     # Training parameters
     parser.add_argument('--batch', type=int, default=10, help="Training set batch size")
-    parser.add_argument('--prefetch', type=int, default=3, help="Number of batches to prefetch")
-    parser.add_argument('--num_parallel_calls', type=int, default=4,
-                        help="Number of threads to use during batch construction")
+    parser.add_argument('--prefetch', type=int, default=-1, help="Number of batches to prefetch (-1 = use AutoTune)")
+    parser.add_argument('--num_parallel_calls', type=int, default=-1,
+                        help="Number of threads to use during batch construction (-1 = use AutoTune)")
     parser.add_argument('--cache', type=str, default=None,
                         help="Cache (default: none; RAM: specify empty string; else specify file")
+    parser.add_argument('--prefetch_to_device', action='store_true', default=True,
+                        help="Prefetch training batches onto the GPU (single GPU only)")
+    parser.add_argument('--no-prefetch_to_device', action='store_false', dest='prefetch_to_device',
+                        help="Do not prefetch training batches onto the GPU")
+    parser.add_argument('--map_and_batch', action='store_true',
+                        help="Use the fused map_and_batch op when constructing batches")
     parser.add_argument('--shuffle', type=int, default=0, help="Size of the shuffle buffer (0 = no shuffle")
 
     parser.add_argument('--generator_seed', type=int, default=42, help="Seed used for generator configuration")
     parser.add_argument('--repeat', action='store_true', help='Continually repeat training set')
     parser.add_argument('--steps_per_epoch', type=int, default=None,
                         help="Number of training batches per epoch (must use --repeat if you are using this)")
+    parser.add_argument('--steps_per_execution', type=int, default=1,
+                        help="Number of training batches to run inside of each tf.function call")
     parser.add_argument('--no_use_py_func', action='store_true', help="False = use py_function in creating the dataset")
 
     # Post